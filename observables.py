@@ -0,0 +1,207 @@
+"""The reactive core of the tree framework: Observable, ObsVar and the
+notification flush machinery.
+
+This lives in its own module so it can be AOT-compiled with mypyc (see
+setup.py): the notification hot path is pure Python attribute and list
+work, exactly what mypyc accelerates, while the wx-facing TreeCtrl stays
+interpreted since it is dominated by wx calls. The module imports and
+behaves identically when the compiled extension is not built.
+"""
+from __future__ import annotations
+
+import inspect
+import logging
+import weakref
+from contextlib import contextmanager
+from typing import Any, Callable, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+import wx
+
+_log = logging.getLogger(__name__)
+
+# Observers are called with no arguments, or with the notification payload
+# if their signature has a required positional parameter.
+Observer = Callable[..., Any]
+
+def _accepts_payload(observer: Observer) -> bool:
+    """True if the observer's first positional parameter is required, i.e.
+    it expects to be handed the notification payload."""
+    try:
+        signature = inspect.signature(observer)
+    except (TypeError, ValueError):
+        return False
+    for parameter in signature.parameters.values():
+        if parameter.kind is inspect.Parameter.VAR_POSITIONAL:
+            return True
+        if parameter.kind in (inspect.Parameter.POSITIONAL_ONLY,
+                              inspect.Parameter.POSITIONAL_OR_KEYWORD):
+            return parameter.default is inspect.Parameter.empty
+        break  # keyword-only or **kwargs: nothing bindable positionally
+    return False
+
+# (observable, payload) pairs queued since the last flush, in
+# notification order
+_dirty_observables: List[Tuple['Observable', Any]] = []
+# True while a process_callbacks call is already pending on the WX thread
+_flush_scheduled = False
+# True while inside batch(); suppresses flush scheduling until exit
+_batching = False
+
+def process_callbacks() -> None:
+    "Called on the WX thread"
+    global _dirty_observables, _flush_scheduled
+    # Clear the guard before dispatching: a notification raised from inside
+    # a callback must be able to schedule the next flush.
+    _flush_scheduled = False
+    dirty = _dirty_observables
+    _dirty_observables = []
+    if not dirty:
+        return
+    # Dedupe while keeping registration order: plain observers run at most
+    # once per flush no matter how many dirtied Observables they watch;
+    # payload observers run once per distinct (observable, payload) since
+    # they need to see each payload.
+    # The collection loop adds entries one by one rather than bulk-merging
+    # observer containers: with the typical one-or-two observers per
+    # Observable, a tight loop over each PyList beats the generic iterator
+    # setup of set.update/dict.update, and the bound setdefault avoids a
+    # method lookup per entry.
+    invocations: dict = {}
+    setdefault = invocations.setdefault
+    for observable, payload in dirty:
+        for entry in observable._observers:
+            if entry is None:  # skip remove_observer tombstones
+                continue
+            callback, wants_payload = entry
+            if wants_payload:
+                # Without an explicit payload, hand over the observable
+                # itself so one handler shared across many observables can
+                # tell which of them changed.
+                key = (callback, id(observable), id(payload))
+                argument = payload if payload is not None else observable
+                setdefault(key, (callback, True, argument))
+            else:
+                setdefault(callback, (callback, False, None))
+    for callback, wants_payload, payload in invocations.values():
+        try:
+            if wants_payload:
+                callback(payload)
+            else:
+                callback()
+        except Exception:
+            # One failing observer must not starve the rest of the flush.
+            _log.exception("observer callback raised")
+
+# Windows whose idle events drain the dirty list (see install_idle_flush);
+# weak so closed windows drop out on their own.
+_idle_windows: 'weakref.WeakSet' = weakref.WeakSet()
+# Milliseconds before the fallback flush fires when no idle event arrives
+# (e.g. the app has no focused window, so the OS sends no idle traffic).
+_IDLE_FALLBACK_MS = 100
+_fallback_timer = None
+
+def install_idle_flush(window) -> None:
+    """Drain notification flushes from `window`'s idle events instead of
+    posting one wx.CallAfter per dirty cycle. The OS paces idle events to
+    roughly frame rate, which caps the flush rate under streaming model
+    updates; a timer acts as a fallback when no idle events arrive."""
+    if window not in _idle_windows:
+        _idle_windows.add(window)
+        window.Bind(wx.EVT_IDLE, _on_idle)
+
+def _on_idle(event) -> None:
+    event.Skip()
+    if _dirty_observables:
+        process_callbacks()
+        if _dirty_observables:
+            # Callbacks dirtied more observables; ask for another idle
+            # event so the backlog drains without waiting for user input.
+            event.RequestMore()
+
+def _schedule_flush() -> None:
+    global _flush_scheduled, _fallback_timer
+    if not _flush_scheduled and not _batching:
+        _flush_scheduled = True
+        if _idle_windows:
+            _fallback_timer = wx.CallLater(_IDLE_FALLBACK_MS, process_callbacks)
+        else:
+            wx.CallAfter(process_callbacks)
+
+@contextmanager
+def batch() -> Iterator[None]:
+    """Suppress flush scheduling for the duration of the block. Use
+    around bulk model updates so all observers run once at the end
+    instead of once per mutation. Reentrant use is not supported."""
+    global _batching
+    _batching = True
+    try:
+        yield
+    finally:
+        _batching = False
+        if _dirty_observables:
+            _schedule_flush()
+
+class Observable:
+    """When an Observable is *triggered* it notifies all its observers.
+
+    Observers are kept in a small list rather than a set: the typical
+    Observable has only a handful of observers, and iterating a list during
+    dispatch is cheaper than hashing every callable. Removal leaves a None
+    tombstone and compacts lazily once a quarter of the entries are dead.
+    """
+    # Slots matter here: a large tree holds an Observable/ObsVar pair per
+    # node, and per-instance __dict__ overhead would dominate its memory.
+    __slots__ = ('_observers', '_dead')
+    def __init__(self) -> None:
+        # Entries are (observer, accepts_payload) pairs; the signature
+        # inspection happens once here rather than on every dispatch.
+        self._observers: List[Optional[Tuple[Observer, bool]]] = []
+        self._dead = 0
+    def add_observer(self, observer: Observer) -> None:
+        for entry in self._observers:
+            if entry is not None and entry[0] == observer:
+                return
+        self._observers.append((observer, _accepts_payload(observer)))
+    def remove_observer(self, observer: Observer) -> None:
+        for index, entry in enumerate(self._observers):
+            if entry is not None and entry[0] == observer:
+                break
+        else:
+            return
+        self._observers[index] = None
+        self._dead += 1
+        if self._dead * 4 > len(self._observers):
+            self._observers = [e for e in self._observers if e is not None]
+            self._dead = 0
+    def notify_observers(self, payload: Any = None) -> None:
+        """Makes all observers execute on the wxPython thread,
+        asynchronously. Observers whose signature takes a required
+        positional argument receive `payload` (or this Observable when no
+        payload was given); the rest are called with no arguments."""
+        _dirty_observables.append((self, payload))
+        _schedule_flush()
+
+ValueType = TypeVar('ValueType')
+
+class ObsVar(Observable, Generic[ValueType]):
+    """An ObsVar (OBServable VARiable) notifies its observers when the
+    value of get() changes.
+    """
+    __slots__ = ('_value',)
+    def __init__(self, value: ValueType):
+        Observable.__init__(self)
+        self._value = value
+    def get(self) -> ValueType:
+        return self._value
+    def set(self, value: ValueType) -> None:
+        # The identity check short-circuits the (possibly structural)
+        # equality compare when the same object is re-assigned.
+        if value is self._value:
+            return
+        if value != self._value:
+            self._value = value
+            self.notify_observers()
+    def force_notify(self) -> None:
+        """Notify observers without changing the value. Needed when the
+        held object was mutated in place, which set() cannot detect."""
+        self.notify_observers()
@@ -0,0 +1,17 @@
+from setuptools import setup
+
+# The reactive core (Observable/ObsVar and the flush machinery) is hot
+# pure-Python code, so compile it with mypyc when available. TreeCtrl in
+# tree_project.py stays interpreted: its time goes into wx calls, which
+# mypyc cannot speed up. Without mypyc the plain .py modules are used.
+try:
+    from mypyc.build import mypycify
+    ext_modules = mypycify(['observables.py'])
+except ImportError:
+    ext_modules = []
+
+setup(
+    name='tree_project',
+    py_modules=['observables', 'tree_project'],
+    ext_modules=ext_modules,
+)
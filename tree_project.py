@@ -14,64 +14,44 @@ documentation is important. You're also encouraged to make notes of
 potential problems and future improvements.
 """
 
-import threading
+import weakref
 from typing import *
-from abc import ABC, abstractmethod
-
-Observer = Callable[[], Any]
-
-# All callbacks scheduled to be called
-_callback_queue = set()
-def process_callbacks() -> None:
-    "Called on the WX thread"
-    while _callback_queue:
-        callback = _callback_queue.pop()
-        callback()
-
-class Observable:
-    """When an Observable is *triggered* it notifies all its observers."""
-    def __init__(self):
-        self._observers : Set[Observer] = set()
-    def add_observer(self, observer : Observer) -> None:
-        self._observers.add(observer)
-    def remove_observer(self, observer : Observer) -> None:
-        self._observers.discard(observer)
-    def notify_observers(self) -> None:
-        "Makes all observers execute on the wxPython thread, asynchronously"
-        invoke = (not _callback_queue)
-        _callback_queue.update(self._observers)
-        if invoke:
-            wx.CallLater(process_callbacks)
-
-ValueType = TypeVar('ValueType')
-
-class ObsVar(Observable, Generic[ValueType]):
-    """An ObsVar (OBServable VARiable) notifies its observers when the
-    value of get() changes.
-    """
-    def __init__(self, value : ValueType):
-        self._value = value
-    def get(self) -> ValueType:
-        return self._value
-    def set(self, value : ValueType) -> None:
-        if value != self._value:
-            self._value = value
-            self.notify_observers()
-
-class TreeNode(ABC):
-    "A node in a tree data structure in the data model"
+
+from observables import (Observer, Observable, ObsVar, ValueType, batch,
+                         install_idle_flush, process_callbacks)
+
+class TreeNode(Protocol):
+    """A node in a tree data structure in the data model.
+
+    A Protocol rather than an ABC: the framework only relies on the shape
+    below, and skipping ABCMeta keeps node construction cheap when a model
+    is built from very many nodes."""
     tree_label : ObsVar[str]
-    @abstractmethod
     def is_tree_leaf(self) -> bool:
         """If True, get_tree_children() will never return any
         nodes. The value is constant for each TreeNode."""
         ...
-    @abstractmethod
     def get_tree_children(self) -> 'Iterable[TreeNode]':
         ...
     # Notifies when the return value of get_tree_children() may have changed
     tree_children_change : Observable
 
+class ChildrenDelta:
+    """Optional payload for tree_children_change notifications describing
+    an incremental edit to `node`'s children. Observers that receive one
+    can patch just the added/removed nodes instead of rebuilding the whole
+    subtree. Set `reordered` when surviving children changed position;
+    that forces a full rebuild."""
+    __slots__ = ('node', 'added', 'removed', 'reordered')
+    def __init__(self, node : 'TreeNode',
+                 added : 'Iterable[TreeNode]' = (),
+                 removed : 'Iterable[TreeNode]' = (),
+                 reordered : bool = False):
+        self.node = node
+        self.added = list(added)
+        self.removed = list(removed)
+        self.reordered = reordered
+
 
 
 
@@ -80,47 +60,265 @@ class TreeCtrl(wx.TreeCtrl):
     "Extends wx.TreeCtrl to use TreeNode as data model"
     def __init__(self, root: TreeNode, parent: wx.Window):
         super().__init__(parent)
-        self._lock = threading.Lock()
-        self._nodes_map = {}  # maps nodes to tree items
-        self._tree_item_map = {}  # maps tree items to nodes
+        # Maps wx item ids (plain integers, cheap to hash) to nodes. The
+        # reverse direction holds nodes weakly so detached subtrees can be
+        # garbage collected together with their map entries.
+        self._item_to_node : Dict[int, TreeNode] = {}
+        self._node_to_item : 'weakref.WeakKeyDictionary[TreeNode, wx.TreeItemId]' = \
+            weakref.WeakKeyDictionary()
+        # Maps id(observable) back to its node for the two shared handlers
+        # below; one bound method serves every node, so no per-node closure
+        # objects are allocated.
+        self._obsvar_to_node : Dict[int, TreeNode] = {}
+        # Item ids whose only child is a placeholder stub; their real
+        # children have not been queried from the model yet.
+        self._stubs : Set[int] = set()
+        # Item ids whose real children are currently materialized, and the
+        # subset whose model children changed since they were built.
+        self._populated : Set[int] = set()
+        self._dirty_items : Set[int] = set()
+        # Expanded items with a repopulation pending for this tick; rebuilt
+        # at most once each when _flush_repop runs.
+        self._pending_repop : Set[int] = set()
+        self._repop_scheduled = False
+        # Snapshot of the children each populated item was built from, so
+        # rebuilds can be diffed down to the actual edit.
+        self._last_children : Dict[int, List[TreeNode]] = {}
         self._root = root
         self._root_item = self.AddRoot(root.tree_label.get())
-        self._nodes_map[root] = self._root_item
-        self._tree_item_map[self._root_item] = root
-        self.Bind(wx.EVT_TREE_ITEM_EXPANDED, self.on_item_expand)
+        self._item_to_node[self._root_item.GetID()] = root
+        self._node_to_item[root] = self._root_item
+        self._add_stub(self._root_item, root)
+        self.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.on_item_expand)
         self.Bind(wx.EVT_TREE_ITEM_COLLAPSED, self.on_item_collapse)
-        root.tree_label.add_observer(self.on_label_change)
-        root.tree_children_change.add_observer(self.on_children_change)
+        install_idle_flush(self.GetTopLevelParent())
+        self._add_observers(root)
 
     def on_item_expand(self, event):
+        assert wx.IsMainThread()
         item = event.GetItem()
-        node = self._tree_item_map[item]
-        self._populate_children(item, node)
+        item_id = item.GetID()
+        if item_id in self._stubs:
+            self._stubs.discard(item_id)
+        elif item_id not in self._dirty_items:
+            # Children retained from an earlier expand are still valid;
+            # expanding again is just a visual toggle.
+            return
+        node = self._item_to_node[item_id]
+        self._rebuild_children(item, node)
 
     def on_item_collapse(self, event):
-        item = event.GetItem()
-        self.DeleteChildren(item)
+        # Keep the materialized children (and their observers) so the next
+        # expand is a pure state toggle; on_children_change invalidates.
+        pass
+
+    def on_children_change(self, payload):
+        # No lock: observer dispatch and tree events both run on the wx
+        # main thread. Background model code must go through
+        # update_from_background().
+        assert wx.IsMainThread()
+        if isinstance(payload, ChildrenDelta):
+            delta : Optional[ChildrenDelta] = payload
+            node = payload.node
+        else:
+            # Payload-less notification: the flush hands us the
+            # tree_children_change Observable that fired.
+            delta = None
+            node = self._obsvar_to_node.get(id(payload))
+        if node is None:
+            return
+        item = self._node_to_item.get(node)
+        if item is None:
+            return
+        item_id = item.GetID()
+        if not self.IsExpanded(item):
+            if item_id in self._populated:
+                # Rebuild lazily on the next expand.
+                self._dirty_items.add(item_id)
+            return
+        if (isinstance(delta, ChildrenDelta) and not delta.reordered
+                and item_id in self._populated
+                and item_id not in self._dirty_items
+                and item_id not in self._pending_repop):
+            # The model told us exactly what changed: patch just those
+            # children and keep the rest of the subtree (and its expand
+            # state) intact.
+            self._apply_children_delta(item, delta)
+            return
+        # No delta (or an untrusted one): coalesce into a full rebuild. A
+        # subtree mutated several times in one tick is rebuilt once when
+        # the pending set is flushed.
+        self._pending_repop.add(item_id)
+        if not self._repop_scheduled:
+            self._repop_scheduled = True
+            wx.CallAfter(self._flush_repop)
+
+    def _apply_children_delta(self, item: wx.TreeItemId,
+                              delta: ChildrenDelta) -> None:
+        "Apply an incremental children edit with O(added+removed) wx work."
+        self.Freeze()
+        try:
+            for child in delta.removed:
+                child_item = self._node_to_item.get(child)
+                if child_item is not None:
+                    self._release_item(child_item, child)
+                    self.Delete(child_item)
+            for child in delta.added:
+                self._append_child(item, child, child.tree_label.get())
+        finally:
+            self.Thaw()
+        # Keep the rebuild snapshot in step with the patched items.
+        snapshot = self._last_children.get(item.GetID())
+        if snapshot is not None:
+            removed = set(delta.removed)
+            snapshot[:] = [c for c in snapshot if c not in removed]
+            snapshot.extend(delta.added)
+
+    def _flush_repop(self):
+        assert wx.IsMainThread()
+        pending, self._pending_repop = self._pending_repop, set()
+        self._repop_scheduled = False
+        if not pending:
+            return
+        self.Freeze()
+        try:
+            for item_id in pending:
+                node = self._item_to_node.get(item_id)
+                if node is None:
+                    continue
+                item = self._node_to_item.get(node)
+                if item is not None:
+                    self._rebuild_children(item, node)
+        finally:
+            self.Thaw()
+
+    def on_label_change(self, obsvar: ObsVar[str]):
+        assert wx.IsMainThread()
+        node = self._obsvar_to_node.get(id(obsvar))
+        if node is None:
+            return
+        item = self._node_to_item.get(node)
+        if item:
+            self.SetItemText(item, obsvar.get())
+
+    @staticmethod
+    def update_from_background(update: Callable[[], Any]) -> None:
+        """Marshal a model update onto the wx main thread. All handlers in
+        this class assume single-threaded access; background threads must
+        route their mutations through here instead of touching ObsVars
+        directly."""
+        wx.CallAfter(update)
+
+    def _add_observers(self, node: TreeNode) -> None:
+        """Register the shared handlers on a node's observables. Their
+        required payload parameter makes the flush pass the observable (or
+        an explicit ChildrenDelta), and _obsvar_to_node maps it back to the
+        node, so no per-node closures are needed and dispatch still touches
+        exactly the affected item."""
+        self._obsvar_to_node[id(node.tree_label)] = node
+        self._obsvar_to_node[id(node.tree_children_change)] = node
+        node.tree_label.add_observer(self.on_label_change)
+        node.tree_children_change.add_observer(self.on_children_change)
+
+    def _release_item(self, item: wx.TreeItemId, node: TreeNode) -> None:
+        """Unregister a node's observers and drop all bookkeeping for its
+        item (and materialized subtree) before the item is deleted."""
+        item_id = item.GetID()
+        if item_id in self._populated:
+            self._release_children(item)
+        node.tree_label.remove_observer(self.on_label_change)
+        node.tree_children_change.remove_observer(self.on_children_change)
+        self._obsvar_to_node.pop(id(node.tree_label), None)
+        self._obsvar_to_node.pop(id(node.tree_children_change), None)
+        self._item_to_node.pop(item_id, None)
+        self._node_to_item.pop(node, None)
+        self._stubs.discard(item_id)
+        self._populated.discard(item_id)
+        self._dirty_items.discard(item_id)
+        self._pending_repop.discard(item_id)
+        self._last_children.pop(item_id, None)
 
-    def on_children_change(self):
-        with self._lock:
-            for node, item in self._nodes_map.items():
-                if item and self.IsExpanded(item):
-                    self.DeleteChildren(item)
-                    self._populate_children(item, node)
+    def _release_children(self, item: wx.TreeItemId) -> None:
+        """Release bookkeeping for all of an item's children, walking each
+        child exactly once."""
+        child_item, cookie = self.GetFirstChild(item)
+        while child_item.IsOk():
+            child = self._item_to_node.get(child_item.GetID())
+            if child is not None:
+                self._release_item(child_item, child)
+            child_item, cookie = self.GetNextChild(item, cookie)
 
+    def _rebuild_children(self, item: wx.TreeItemId, node: TreeNode) -> None:
+        """Bring an item's materialized children up to date with the model.
 
-    def on_label_change(self):
-        with self._lock:
-            for node, item in self._nodes_map.items():
-                if item:
-                    self.SetItemText(item, node.tree_label.get())
+        When a previous snapshot of the children exists, the new list is
+        diffed against it and only the added/removed items get wx calls,
+        which also preserves the expand state of untouched subtrees. The
+        full delete-and-repopulate only happens on first populate or when
+        surviving children changed order."""
+        item_id = item.GetID()
+        self._dirty_items.discard(item_id)
+        # Pull everything needed from the model up front, so the wx calls
+        # below run back to back while frozen.
+        materials = [(child, child.tree_label.get())
+                     for child in node.get_tree_children()]
+        old = self._last_children.get(item_id)
+        # Freeze so N inserts cause one repaint/layout pass, not N. wx
+        # refcounts Freeze, so nesting under a frozen caller is fine.
+        self.Freeze()
+        try:
+            if old is None or not self._patch_children(item, old, materials):
+                self._release_children(item)
+                self.DeleteChildren(item)
+                for child_node, label in materials:
+                    self._append_child(item, child_node, label)
+        finally:
+            self.Thaw()
+        self._last_children[item_id] = [child for child, _ in materials]
+        self._populated.add(item_id)
 
+    def _patch_children(self, item: wx.TreeItemId, old: List[TreeNode],
+                        materials: List[Tuple[TreeNode, str]]) -> bool:
+        """Try to turn the children shown under `item` (previously built
+        from `old`) into `materials` with one wx call per added or removed
+        child. Returns False when the surviving children were reordered,
+        in which case the caller falls back to a full rebuild."""
+        new_nodes = [child for child, _ in materials]
+        old_set = set(old)
+        new_set = set(new_nodes)
+        survivors_old = [c for c in old if c in new_set]
+        survivors_new = [c for c in new_nodes if c in old_set]
+        if survivors_old != survivors_new:
+            return False
+        for child in old:
+            if child not in new_set:
+                child_item = self._node_to_item.get(child)
+                if child_item is not None:
+                    self._release_item(child_item, child)
+                    self.Delete(child_item)
+        for position, (child, label) in enumerate(materials):
+            if child not in old_set:
+                self._append_child(item, child, label, position)
+        return True
 
+    def _add_stub(self, item: wx.TreeItemId, node: TreeNode) -> None:
+        """Append a placeholder child so the expander arrow shows, without
+        querying the model for the real children yet."""
+        if not node.is_tree_leaf():
+            self.AppendItem(item, "")
+            self._stubs.add(item.GetID())
 
-    def _populate_children(self, item: wx.TreeItemId, node: TreeNode):
-        for child_node in node.get_tree_children():
-            child_item = self.AppendItem(item, child_node.tree_label.get())
-            self._nodes_map[child_node] = child_item
-            self._tree_item_map[child_item] = child_node
-            child_node.tree_label.add_observer(self.on_label_change)
-            child_node.tree_children_change.add_observer(self.on_children_change)
+    def _append_child(self, item: wx.TreeItemId, child_node: TreeNode,
+                      label: str,
+                      position: Optional[int] = None) -> wx.TreeItemId:
+        """Append (or insert at `position`) one child item and wire up its
+        maps, observers and stub."""
+        if position is None:
+            child_item = self.AppendItem(item, label)
+        else:
+            child_item = self.InsertItem(item, position, label)
+        self._item_to_node[child_item.GetID()] = child_node
+        self._node_to_item[child_node] = child_item
+        self._add_observers(child_node)
+        self._add_stub(child_item, child_node)
+        return child_item